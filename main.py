@@ -1,8 +1,12 @@
 import asyncio
 import os
 import io
-from datetime import datetime
-from typing import Optional, Iterable
+import re
+import inspect
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from typing import Optional, Iterable, AsyncIterator
 import openpyxl
 from openpyxl.utils import get_column_letter
 
@@ -11,12 +15,13 @@ import asyncpg
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
-    Message, User as TgUser, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile
+    Message, User as TgUser, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 )
 from dotenv import load_dotenv
 
@@ -47,21 +52,163 @@ def _parse_id_list(s: str | None) -> list[int]:
 SEED_SUPERADMINS = _parse_id_list(os.getenv("SUPERADMIN_IDS"))
 SEED_ADMINS = _parse_id_list(os.getenv("ADMIN_IDS"))
 
+# Telegram limitlari: ~30 msg/s global (ozgina zaxira qoldiramiz), 1 msg/s har bir chatga
+TG_GLOBAL_RPS = 28
+TG_PER_CHAT_RPS = 1
+
+# Broadcastda bir vaqtda nechta so'rov ochiq turadi (TG_GLOBAL_RPS dan oshmasin)
+BROADCAST_CONCURRENCY = 25
+# Bitta userga yuborish shu vaqtdan (s) oshsa — xato deb hisoblaymiz, worker bo'shaydi
+BROADCAST_SEND_TIMEOUT = 15
+# Broadcast navbatining maksimal uzunligi (RAMda bir vaqtda turadigan id'lar)
+BROADCAST_QUEUE_SIZE = 1000
+# Har nechta yuborishdan keyin adminga progress ko'rsatiladi
+BROADCAST_PROGRESS_EVERY = 500
+# Relayda adminlarga bir vaqtda nechta so'rov
+RELAY_CONCURRENCY = 10
+# Telegram xabar matni limiti (UTF-16 belgilar)
+TG_MAX_TEXT_LEN = 4096
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=MemoryStorage())
 
 # Eksport fayl nomi (diskga yozmaymiz, lekin nom zarur)
 
+# =========================
+# Rate limit (Telegram: ~30 msg/s global, 1 msg/s har bir chatga)
+# =========================
+class AsyncRateLimiter:
+    def __init__(self, global_rate: float, per_chat_rate: float, max_chats: int = 10_000):
+        self._global_interval = 1.0 / global_rate
+        self._chat_interval = 1.0 / per_chat_rate
+        self._max_chats = max_chats
+        self._lock = asyncio.Lock()
+        self._next_global = 0.0
+        # chat_id -> oxirgi yuborish vaqti (LRU bo'yicha tozalanadi)
+        self._last_sent: OrderedDict[int, float] = OrderedDict()
+
+    async def acquire(self, chat_id: int):
+        # Avval shu chatning o'z navbatini kutamiz (boshqa chatlarni ushlab turmaydi),
+        # keyin global slotni band qilamiz. Lock ichida faqat hisob-kitob, kutish tashqarida.
+        async with self._lock:
+            now = time.monotonic()
+            last = self._last_sent.get(chat_id)
+            chat_at = now if last is None else max(now, last + self._chat_interval)
+            self._last_sent[chat_id] = chat_at
+            self._last_sent.move_to_end(chat_id)
+            if len(self._last_sent) > self._max_chats:
+                self._last_sent.popitem(last=False)
+        if chat_at > now:
+            await asyncio.sleep(chat_at - now)
+
+        async with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_global)
+            self._next_global = at + self._global_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def backoff(self, seconds: float):
+        # 429 (flood) — global limit buzilgan: barcha worker'lar shu vaqtgacha kutadi
+        self._next_global = max(self._next_global, time.monotonic() + seconds)
+
+
+# Broadcast, relay va reply — hammasi shu bitta limiter orqali
+limiter = AsyncRateLimiter(global_rate=TG_GLOBAL_RPS, per_chat_rate=TG_PER_CHAT_RPS)
+
+async def tg_send(chat_id: int, call):
+    # call: har safar yangi coroutine qaytaradigan funksiya (retry uchun)
+    while True:
+        await limiter.acquire(chat_id)
+        try:
+            return await call()
+        except TelegramRetryAfter as e:
+            limiter.backoff(e.retry_after)
+
 # =========================
 # DB Layer
 # =========================
+# Adminlar keshi: har bir update'da DBga bormaslik uchun.
+# TTL tugaganda yoki add/remove'dan keyin (invalidate) DBdan qayta yuklanadi.
+ADMIN_CACHE_TTL = 30.0
+
+class AdminCache:
+    def __init__(self):
+        self.ids: frozenset[int] = frozenset()
+        self.superadmin_ids: frozenset[int] = frozenset()
+        self.expires_at: float = 0.0
+        # har invalidate()'da oshadi: undan oldin boshlangan yuklash natijasi yozilmaydi
+        self.generation: int = 0
+
+    def invalidate(self):
+        self.generation += 1
+        self.expires_at = 0.0
+
+    def store(self, ids: frozenset[int], superadmin_ids: frozenset[int], generation: int) -> bool:
+        if generation != self.generation:
+            return False
+        self.ids = ids
+        self.superadmin_ids = superadmin_ids
+        self.expires_at = time.monotonic() + ADMIN_CACHE_TTL
+        return True
+
+_admin_cache = AdminCache()
+_admin_cache_lock = asyncio.Lock()
+
+# Eksportda cursor'dan bir safarda olinadigan qatorlar soni
+EXPORT_BATCH_SIZE = 2000
+# Broadcast uchun user id'lar DBdan shu o'lchamdagi sahifalar bilan o'qiladi
+USER_ID_PAGE_SIZE = 1000
+
+# Profil o'zgarmagan bo'lsa, bitta user shu oraliqda (s) qayta upsert qilinmaydi
+USER_UPSERT_INTERVAL = 300.0
+USER_SEEN_MAX = 10_000
+
+def _append_user_rows(ws, rows: Iterable[asyncpg.Record]):
+    for r in rows:
+        ws.append([
+            r["tg_id"],
+            f"@{r['username']}" if r["username"] else "-",
+            r["first_name"] or "-",
+            r["last_name"] or "-",
+            r["created_at"].strftime("%Y-%m-%d %H:%M:%S"),
+        ])
+
+def _workbook_buffer(wb: openpyxl.Workbook) -> io.BytesIO:
+    # RAMga yozamiz
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return buf
+
+class BytesIOInputFile(InputFile):
+    # BufferedInputFile bytes talab qiladi (getvalue() = to'liq nusxa);
+    # bu esa tayyor bufferdan to'g'ridan-to'g'ri bo'lakma-bo'lak o'qiydi
+    def __init__(self, buf: io.BytesIO, filename: str):
+        super().__init__(filename=filename)
+        self._buf = buf
+
+    async def read(self, bot: Bot):
+        self._buf.seek(0)
+        while chunk := self._buf.read(self.chunk_size):
+            yield chunk
+
 class DB:
     def __init__(self, dsn: str):
         self._dsn = dsn
         self.pool: asyncpg.Pool | None = None
+        # tg_id -> (oxirgi upsert vaqti, profil) — LRU bo'yicha tozalanadi
+        self._seen: OrderedDict[int, tuple[float, tuple]] = OrderedDict()
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(self._dsn, min_size=1, max_size=10)
+        # min_size ta ulanish pool ochilganda darhol o'rnatiladi (TCP+auth oldindan)
+        self.pool = await asyncpg.create_pool(
+            self._dsn,
+            min_size=4,
+            max_size=20,
+            max_inactive_connection_lifetime=300,
+            statement_cache_size=1024,
+            command_timeout=10,
+        )
 
     async def close(self):
         if self.pool:
@@ -83,133 +230,172 @@ class DB:
         );
         CREATE INDEX IF NOT EXISTS idx_users_username ON users ((lower(coalesce(username,''))));
         """
-        async with self.pool.acquire() as con:
-            await con.execute(sql)
+        await self.pool.execute(sql)
 
     async def seed_admins(self, super_ids: Iterable[int], admin_ids: Iterable[int]):
-        # insert if not exists
+        # insert if not exists — har bir rol uchun bitta so'rov (unnest)
         async with self.pool.acquire() as con:
             async with con.transaction():
-                for uid in set(super_ids or []):
-                    await con.execute(
-                        "INSERT INTO admins(tg_id, role) VALUES($1,'super') ON CONFLICT (tg_id) DO NOTHING",
-                        uid,
-                    )
-                for uid in set(admin_ids or []):
-                    # agar super bo'lsa, yana admin qo'ymaymiz
-                    await con.execute(
-                        """
-                        INSERT INTO admins(tg_id, role) 
-                        SELECT $1,'admin'
-                        WHERE NOT EXISTS (SELECT 1 FROM admins WHERE tg_id=$1)
-                        """,
-                        uid,
-                    )
+                await con.execute(
+                    """
+                    INSERT INTO admins(tg_id, role)
+                    SELECT x, 'super' FROM unnest($1::bigint[]) AS t(x)
+                    ON CONFLICT (tg_id) DO NOTHING
+                    """,
+                    list(set(super_ids or [])),
+                )
+                # agar super bo'lsa, yana admin qo'ymaymiz
+                await con.execute(
+                    """
+                    INSERT INTO admins(tg_id, role)
+                    SELECT x, 'admin' FROM unnest($1::bigint[]) AS t(x)
+                    WHERE NOT EXISTS (SELECT 1 FROM admins a WHERE a.tg_id=t.x)
+                    """,
+                    list(set(admin_ids or [])),
+                )
 
     # --- Users ---
     async def upsert_user(self, u: TgUser):
-        async with self.pool.acquire() as con:
-            await con.execute(
-                """
-                INSERT INTO users(tg_id, username, first_name, last_name)
-                VALUES($1, $2, $3, $4)
-                ON CONFLICT (tg_id) DO UPDATE
-                  SET username=EXCLUDED.username,
-                      first_name=EXCLUDED.first_name,
-                      last_name=EXCLUDED.last_name
-                """,
-                u.id, u.username, u.first_name, u.last_name
-            )
+        await self.pool.execute(
+            """
+            INSERT INTO users(tg_id, username, first_name, last_name)
+            VALUES($1, $2, $3, $4)
+            ON CONFLICT (tg_id) DO UPDATE
+              SET username=EXCLUDED.username,
+                  first_name=EXCLUDED.first_name,
+                  last_name=EXCLUDED.last_name
+            """,
+            u.id, u.username, u.first_name, u.last_name
+        )
 
-    async def list_user_ids(self) -> list[int]:
-        async with self.pool.acquire() as con:
-            rows = await con.fetch("SELECT tg_id FROM users ORDER BY tg_id")
-            return [r["tg_id"] for r in rows]
+    async def touch_user(self, u: TgUser):
+        # Faol user har xabarida DBga yozmaymiz: profil o'zgarmagan bo'lsa
+        # USER_UPSERT_INTERVAL ichida upsert o'tkazib yuboriladi
+        profile = (u.username, u.first_name, u.last_name)
+        now = time.monotonic()
+        seen = self._seen.get(u.id)
+        if seen and seen[1] == profile and now - seen[0] < USER_UPSERT_INTERVAL:
+            return
+        await self.upsert_user(u)
+        self._seen[u.id] = (now, profile)
+        self._seen.move_to_end(u.id)
+        if len(self._seen) > USER_SEEN_MAX:
+            self._seen.popitem(last=False)
+
+    async def bulk_upsert_users(self, users: Iterable[TgUser]):
+        # K ta user — bitta so'rov (unnest), ommaviy import/backfill uchun
+        # bir tg_id ikki marta kelsa ON CONFLICT xato beradi — oxirgisini olamiz
+        users = list({u.id: u for u in users}.values())
+        if not users:
+            return
+        await self.pool.execute(
+            """
+            INSERT INTO users(tg_id, username, first_name, last_name)
+            SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[])
+            ON CONFLICT (tg_id) DO UPDATE
+              SET username=EXCLUDED.username,
+                  first_name=EXCLUDED.first_name,
+                  last_name=EXCLUDED.last_name
+            """,
+            [u.id for u in users],
+            [u.username for u in users],
+            [u.first_name for u in users],
+            [u.last_name for u in users],
+        )
+
+    async def count_users(self) -> int:
+        return await self.pool.fetchval("SELECT count(*) FROM users")
+
+    async def iter_user_ids(self) -> AsyncIterator[int]:
+        # Keyset pagination: sahifama-sahifa o'qiymiz. Server-side cursor broadcast davomida
+        # (soatlab) ulanish va tranzaksiyani band qilib turardi — bu yerda har sahifa alohida so'rov.
+        last = 0  # Telegram user id'lari musbat
+        while True:
+            rows = await self.pool.fetch(
+                "SELECT tg_id FROM users WHERE tg_id > $1 ORDER BY tg_id LIMIT $2",
+                last, USER_ID_PAGE_SIZE,
+            )
+            if not rows:
+                return
+            for r in rows:
+                yield r["tg_id"]
+            last = rows[-1]["tg_id"]
 
     async def find_user_id_by_username(self, token: str) -> Optional[int]:
         # token: '@username' yoki 'username' bo'lishi mumkin
-        token = token.strip()
-        if token.startswith("@"):
-            token = token[1:]
-        token = token.lower()
+        token = token.strip().removeprefix("@").lower()
         if not token:
             return None
-        async with self.pool.acquire() as con:
-            row = await con.fetchrow(
-                "SELECT tg_id FROM users WHERE lower(coalesce(username,''))=$1",
-                token
-            )
-            return row["tg_id"] if row else None
-
-    async def export_users_xlsx_bytes(self) -> bytes:
-        async with self.pool.acquire() as con:
-            rows = await con.fetch(
-                "SELECT tg_id, username, first_name, last_name, created_at FROM users ORDER BY tg_id"
-            )
+        # idx_users_username (lower(coalesce(username,''))) bo'yicha index lookup
+        row = await self.pool.fetchrow(
+            "SELECT tg_id FROM users WHERE lower(coalesce(username,''))=$1",
+            token
+        )
+        return row["tg_id"] if row else None
 
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Users"
+    async def export_users_xlsx_stream(self) -> io.BytesIO:
+        # write_only: Cell obyektlari xotirada to'planmaydi, qatorlar oqim bilan yoziladi
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Users")
 
         # Sarlavhalar
         headers = ["Telegram ID", "Username", "First name", "Last name", "Created at"]
-        ws.append(headers)
-
-        # Ma’lumotlar
-        for r in rows:
-            ws.append([
-                r["tg_id"],
-                f"@{r['username']}" if r["username"] else "-",
-                r["first_name"] or "-",
-                r["last_name"] or "-",
-                r["created_at"].strftime("%Y-%m-%d %H:%M:%S"),
-            ])
-
-        # Avtomatik ustun kengligi
-        for i, col in enumerate(ws.columns, 1):
-            max_len = max(len(str(cell.value)) if cell.value else 0 for cell in col)
-            ws.column_dimensions[get_column_letter(i)].width = max_len + 2
-
-        # RAMga yozamiz
-        import io
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
-        return buf.read()
 
-
-    # --- Admins ---
-    async def list_admin_ids(self) -> set[int]:
         async with self.pool.acquire() as con:
-            rows = await con.fetch("SELECT tg_id FROM admins WHERE role IN ('admin','super')")
-            return {r["tg_id"] for r in rows}
+            async with con.transaction():
+                # Ustun kengligi write_only rejimda qatorlardan oldin berilishi shart,
+                # shuning uchun maksimal uzunliklarni DBning o'zidan olamiz
+                w = await con.fetchrow(
+                    """
+                    SELECT
+                      coalesce(max(length(tg_id::text)), 0) AS tg_id,
+                      coalesce(max(CASE WHEN coalesce(username,'')='' THEN 1
+                                        ELSE length(username) + 1 END), 0) AS username,
+                      coalesce(max(greatest(length(coalesce(first_name,'')), 1)), 0) AS first_name,
+                      coalesce(max(greatest(length(coalesce(last_name,'')), 1)), 0) AS last_name,
+                      CASE WHEN count(*) > 0 THEN 19 ELSE 0 END AS created_at
+                    FROM users
+                    """
+                )
+                # Avtomatik ustun kengligi
+                for i, (h, n) in enumerate(zip(headers, w.values()), 1):
+                    ws.column_dimensions[get_column_letter(i)].width = max(len(h), n) + 2
 
-    async def list_super_ids(self) -> set[int]:
-        async with self.pool.acquire() as con:
-            rows = await con.fetch("SELECT tg_id FROM admins WHERE role='super'")
-            return {r["tg_id"] for r in rows}
+                ws.append(headers)
 
-    async def is_admin(self, uid: int) -> bool:
-        async with self.pool.acquire() as con:
-            row = await con.fetchrow("SELECT 1 FROM admins WHERE tg_id=$1", uid)
-            return bool(row)
+                # Ma’lumotlar: server-side cursor, paketlab o'qiymiz; openpyxl ishi
+                # (CPU) alohida threadda — event loop boshqa update'larni bloklamaydi
+                cur = await con.cursor(
+                    "SELECT tg_id, username, first_name, last_name, created_at FROM users ORDER BY tg_id"
+                )
+                while True:
+                    batch = await cur.fetch(EXPORT_BATCH_SIZE)
+                    if not batch:
+                        break
+                    await asyncio.to_thread(_append_user_rows, ws, batch)
+
+        return await asyncio.to_thread(_workbook_buffer, wb)
 
-    async def is_super(self, uid: int) -> bool:
-        async with self.pool.acquire() as con:
-            row = await con.fetchrow("SELECT 1 FROM admins WHERE tg_id=$1 AND role='super'", uid)
-            return bool(row)
+
+    # --- Admins ---
+    async def load_admin_roles(self) -> tuple[frozenset[int], frozenset[int]]:
+        # (barcha adminlar, superadminlar) — bitta so'rov bilan
+        rows = await self.pool.fetch("SELECT tg_id, role FROM admins")
+        ids = frozenset(r["tg_id"] for r in rows)
+        supers = frozenset(r["tg_id"] for r in rows if r["role"] == "super")
+        return ids, supers
 
     async def add_admin(self, uid: int) -> bool:
         # superga aylantirmaymiz, oddiy admin
-        async with self.pool.acquire() as con:
-            try:
-                await con.execute(
-                    "INSERT INTO admins(tg_id, role) VALUES($1,'admin')",
-                    uid
-                )
-                return True
-            except asyncpg.UniqueViolationError:
-                return False
+        try:
+            await self.pool.execute(
+                "INSERT INTO admins(tg_id, role) VALUES($1,'admin')",
+                uid
+            )
+        except asyncpg.UniqueViolationError:
+            return False
+        _admin_cache.invalidate()
+        return True
 
     async def remove_admin(self, uid: int) -> bool:
         # superadminni o'chirmaymiz (xavfsizlik)
@@ -221,23 +407,64 @@ class DB:
                 if row["role"] == "super":
                     return False
                 await con.execute("DELETE FROM admins WHERE tg_id=$1", uid)
-                return True
+        # COMMITdan keyin: aks holda parallel yuklash eski qatorni qayta keshlab qo'yishi mumkin
+        _admin_cache.invalidate()
+        return True
 
     async def list_admins_text(self) -> str:
-        async with self.pool.acquire() as con:
-            supers = await con.fetch(
-                "SELECT tg_id FROM admins WHERE role='super' ORDER BY tg_id"
-            )
-            admins = await con.fetch(
-                "SELECT tg_id FROM admins WHERE role='admin' ORDER BY tg_id"
-            )
-        s_supers = "\n".join([f"• <code>{r['tg_id']}</code>" for r in supers]) or "—"
-        s_admins = "\n".join([f"• <code>{r['tg_id']}</code>" for r in admins]) or "—"
+        rows = await self.pool.fetch(
+            "SELECT tg_id, role FROM admins ORDER BY role DESC, tg_id"
+        )
+        supers = [r["tg_id"] for r in rows if r["role"] == "super"]
+        admins = [r["tg_id"] for r in rows if r["role"] == "admin"]
+        s_supers = "\n".join([f"• <code>{uid}</code>" for uid in supers]) or "—"
+        s_admins = "\n".join([f"• <code>{uid}</code>" for uid in admins]) or "—"
         return f"<b>👑 Superadmins</b>\n{s_supers}\n\n<b>🛡 Admins</b>\n{s_admins}"
 
 
 db = DB(DATABASE_URL)
 
+# =========================
+# Role utils (AdminCache orqali, TTL bilan)
+# =========================
+async def _cache() -> AdminCache:
+    if _admin_cache.expires_at <= time.monotonic():
+        async with _admin_cache_lock:
+            # lockni kutganimizda boshqasi yangilab qo'ygan bo'lishi mumkin;
+            # yuklash paytida invalidate() bo'lsa, natija eskirgan — qaytadan yuklaymiz
+            while _admin_cache.expires_at <= time.monotonic():
+                generation = _admin_cache.generation
+                ids, supers = await db.load_admin_roles()
+                _admin_cache.store(ids, supers, generation)
+    return _admin_cache
+
+async def is_admin(user_id: int) -> bool:
+    return user_id in (await _cache()).ids
+
+def admin_required(level: str = "admin"):
+    # Handler boshidagi admin/superadmin tekshiruvi — bitta AdminCache snapshot bilan.
+    # Handler `snap` parametrini e'lon qilsa, AdminCache snapshot'i shu nom bilan beriladi.
+    def deco(fn):
+        wants_snap = "snap" in inspect.signature(fn).parameters
+
+        @wraps(fn)
+        async def wrap(event, *args, **kwargs):
+            snap = await _cache()
+            uid = event.from_user.id
+            if level == "super":
+                if uid not in snap.superadmin_ids:
+                    if isinstance(event, CallbackQuery):
+                        await event.answer("Faqat superadmin uchun.", show_alert=True)
+                    return
+            elif uid not in snap.ids:
+                return
+            if wants_snap:
+                kwargs["snap"] = snap
+            return await fn(event, *args, **kwargs)
+        return wrap
+    return deco
+
+
 # =========================
 # States
 # =========================
@@ -253,12 +480,72 @@ class AdminMgmtStates(StatesGroup):
     waiting_add = State()
     waiting_remove = State()
 
+# =========================
+# Broadcast (worker pool)
+# =========================
+async def run_broadcast(
+    src: Message, user_ids: AsyncIterator[int], total: int, status: Message | None = None
+) -> tuple[int, int]:
+    # Har user uchun Task yaratmaymiz: BROADCAST_CONCURRENCY ta worker navbatdan oladi.
+    # Navbat chegaralangan — idlar DBdan kelgan sari to'ldiriladi, hammasi RAMga yig'ilmaydi.
+    ok = 0
+    fail = 0
+    queued = 0
+    producer_failed = False
+
+    q: asyncio.Queue[int | None] = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+
+    async def producer():
+        nonlocal queued, producer_failed
+        try:
+            async for uid in user_ids:
+                await q.put(uid)
+                queued += 1
+        except Exception:
+            # DB xatosi: navbatdagilar yuboriladi, qolganlari xato deb hisoblanadi
+            producer_failed = True
+        finally:
+            for _ in range(BROADCAST_CONCURRENCY):
+                await q.put(None)  # sentinel: worker to'xtaydi
+
+    async def worker():
+        nonlocal ok, fail
+        while (uid := await q.get()) is not None:
+            try:
+                # timeout faqat HTTP so'rovning o'ziga: limiter va RetryAfter kutishi hisobga kirmaydi
+                await tg_send(
+                    uid,
+                    lambda: asyncio.wait_for(src.copy_to(chat_id=uid), BROADCAST_SEND_TIMEOUT),
+                )
+                ok += 1
+            except Exception:
+                fail += 1
+            done = ok + fail
+            if status and done % BROADCAST_PROGRESS_EVERY == 0 and done < total:
+                text = f"⏳ Broadcast: {done} / {total}\nYuborildi: {ok} / Xato: {fail}"
+                try:
+                    # progress ham o'sha limiter orqali — o'zi RetryAfter chaqirmasin
+                    await tg_send(status.chat.id, lambda: status.edit_text(text))
+                except Exception:
+                    pass
+
+    await asyncio.gather(producer(), *(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    if producer_failed:
+        fail += max(total - queued, 0)
+    if status:
+        # Yakuniy holat (oraliq progress faqat har BROADCAST_PROGRESS_EVERY da edi)
+        text = f"✅ Broadcast: {ok + fail} / {total}\nYuborildi: {ok} / Xato: {fail}"
+        try:
+            await tg_send(status.chat.id, lambda: status.edit_text(text))
+        except Exception:
+            pass
+    return ok, fail
+
 
 
 @dp.callback_query(F.data == "panel:broadcast")
+@admin_required()
 async def panel_broadcast(cq: CallbackQuery, state: FSMContext):
-    if not await is_admin(cq.from_user.id):
-        return
     await state.set_state(BroadcastStates.waiting_content)
     await cq.message.answer(
         "Broadcast rejimi: Menga <b>bitta xabar</b> yubor.\n"
@@ -269,10 +556,8 @@ async def panel_broadcast(cq: CallbackQuery, state: FSMContext):
 
 
 @dp.message(BroadcastStates.waiting_content)
+@admin_required()
 async def broadcast_preview(msg: Message, state: FSMContext):
-    if not await is_admin(msg.from_user.id):
-        return
-
     # Xabarni keyin yuborish uchun saqlab qo'yamiz
     await state.update_data(draft_msg=msg)
 
@@ -288,10 +573,8 @@ async def broadcast_preview(msg: Message, state: FSMContext):
     await state.set_state(BroadcastStates.confirm_content)
 
 @dp.callback_query(F.data == "broadcast:confirm")
+@admin_required()
 async def broadcast_confirm(cq: CallbackQuery, state: FSMContext):
-    if not await is_admin(cq.from_user.id):
-        return
-
     data = await state.get_data()
     draft: Message = data.get("draft_msg")
     if not draft:
@@ -299,23 +582,10 @@ async def broadcast_confirm(cq: CallbackQuery, state: FSMContext):
         await state.clear()
         return
 
-    user_ids = await db.list_user_ids()
-    total = len(user_ids)
-    ok = 0
-    fail = 0
-
-    sem = asyncio.Semaphore(20)
-
-    async def send_copy(uid: int):
-        nonlocal ok, fail
-        async with sem:
-            try:
-                await draft.copy_to(chat_id=uid)
-                ok += 1
-            except Exception:
-                fail += 1
+    total = await db.count_users()
 
-    await asyncio.gather(*(send_copy(uid) for uid in user_ids))
+    status = await cq.message.answer(f"⏳ Broadcast boshlandi: 0 / {total}")
+    ok, fail = await run_broadcast(draft, db.iter_user_ids(), total, status)
 
     await state.clear()
     await cq.message.answer(
@@ -324,9 +594,8 @@ async def broadcast_confirm(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @dp.callback_query(F.data == "broadcast:cancel")
+@admin_required()
 async def broadcast_cancel(cq: CallbackQuery, state: FSMContext):
-    if not await is_admin(cq.from_user.id):
-        return
     await state.clear()
     await cq.message.answer("❌ Broadcast bekor qilindi.")
     await cq.answer()
@@ -334,7 +603,8 @@ async def broadcast_cancel(cq: CallbackQuery, state: FSMContext):
 # =========================
 # Keyboards
 # =========================
-def panel_kb(superadmin: bool):
+# Klaviaturalar o'zgarmas — bir marta quriladi, keyin tayyor obyekt qaytariladi
+def _build_panel_kb(superadmin: bool):
     rows = [
         [InlineKeyboardButton(text="✉️ Broadcast", callback_data="panel:broadcast")],
         [InlineKeyboardButton(text="👥 Users count", callback_data="panel:count")],
@@ -344,6 +614,13 @@ def panel_kb(superadmin: bool):
         rows.append([InlineKeyboardButton(text="👑 Manage Admins", callback_data="panel:admins")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+_PANEL_KB_ADMIN = _build_panel_kb(False)
+_PANEL_KB_SUPER = _build_panel_kb(True)
+
+def panel_kb(superadmin: bool):
+    return _PANEL_KB_SUPER if superadmin else _PANEL_KB_ADMIN
+
+@lru_cache(maxsize=4096)
 def reply_kb(user_id: int, superadmin: bool):
     row = [InlineKeyboardButton(text="✍️ Javob qaytarish", callback_data=f"reply:{user_id}")]
     rows = [row]
@@ -354,123 +631,70 @@ def reply_kb(user_id: int, superadmin: bool):
         ])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def admins_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Add admin", callback_data="admins:add")],
-        [InlineKeyboardButton(text="➖ Remove admin", callback_data="admins:remove")],
-        [InlineKeyboardButton(text="📄 List admins", callback_data="admins:list")],
-        [InlineKeyboardButton(text="↩️ Back", callback_data="panel:back")],
-    ])
-
-# =========================
-# Role utils (DB-based)
-# =========================
-async def all_admin_ids() -> set[int]:
-    return await db.list_admin_ids()
-
-async def is_superadmin(user_id: int) -> bool:
-    return await db.is_super(user_id)
+_ADMINS_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Add admin", callback_data="admins:add")],
+    [InlineKeyboardButton(text="➖ Remove admin", callback_data="admins:remove")],
+    [InlineKeyboardButton(text="📄 List admins", callback_data="admins:list")],
+    [InlineKeyboardButton(text="↩️ Back", callback_data="panel:back")],
+])
 
-async def is_admin(user_id: int) -> bool:
-    return await db.is_admin(user_id)
+def admins_menu_kb():
+    return _ADMINS_MENU_KB
 
 # =========================
 # Handlers
 # =========================
 @dp.message(Command("admin"))
-async def cmd_panel(msg: Message):
-    if not await is_admin(msg.from_user.id):
-        return
+@admin_required()
+async def cmd_panel(msg: Message, snap: AdminCache):
     await msg.answer(
         "Admin panel:",
-        reply_markup=panel_kb(superadmin=await is_superadmin(msg.from_user.id)),
+        reply_markup=panel_kb(superadmin=msg.from_user.id in snap.superadmin_ids),
     )
 
 @dp.callback_query(F.data == "panel:back")
-async def panel_back(cq: CallbackQuery):
-    if not await is_admin(cq.from_user.id):
-        return
+@admin_required()
+async def panel_back(cq: CallbackQuery, snap: AdminCache):
     await cq.message.edit_text(
         "Admin panel:",
-        reply_markup=panel_kb(superadmin=await is_superadmin(cq.from_user.id)),
+        reply_markup=panel_kb(superadmin=cq.from_user.id in snap.superadmin_ids),
     )
     await cq.answer()
 
-@dp.callback_query(F.data.startswith("panel:"))
-async def panel_actions(cq: CallbackQuery, state: FSMContext):
-    if not await is_admin(cq.from_user.id):
-        return
-    action = cq.data.split(":", 1)[1]
-
-    if action == "broadcast":
-        await state.set_state(BroadcastStates.waiting_content)
-        await cq.message.answer(
-            "📢 Broadcast rejimi boshlandi.\n"
-            "Menga bir dona xabar yuboring, men uni barcha foydalanuvchilarga tarqataman.\n\n"
-            "❌ Agar fikringizdan qaytsangiz, /cancel buyrug‘ini yuboring."
-        )
-    elif action == "export":
-        data = await db.export_users_xlsx_bytes()
-        tmp_path = "users.xlsx"
-        with open(tmp_path, "wb") as f:
-            f.write(data)
-        try:
-            doc = FSInputFile(tmp_path)
-            await cq.message.answer_document(document=doc, caption="users.xlsx")
-        finally:
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+# panel:broadcast — yuqoridagi panel_broadcast handlerida
+@dp.callback_query(F.data == "panel:export")
+@admin_required()
+async def panel_export(cq: CallbackQuery):
+    # Diskka yozmaymiz: baytlar to'g'ridan-to'g'ri RAMdan yuboriladi
+    buf = await db.export_users_xlsx_stream()
+    doc = BytesIOInputFile(buf, filename="users.xlsx")
+    await cq.message.answer_document(document=doc, caption="users.xlsx")
+    await cq.answer()
 
-    elif action == "admins":
-        if not await is_superadmin(cq.from_user.id):
-            await cq.answer("Faqat superadmin uchun.", show_alert=True)
-            return
-        await cq.message.answer("👑 Admin Management", reply_markup=admins_menu_kb())
+@dp.callback_query(F.data == "panel:admins")
+@admin_required("super")
+async def panel_admins(cq: CallbackQuery):
+    await cq.message.answer("👑 Admin Management", reply_markup=admins_menu_kb())
+    await cq.answer()
+
+@dp.callback_query(F.data.startswith("panel:"))
+@admin_required()
+async def panel_actions(cq: CallbackQuery):
+    # Qolgan panel tugmalari (masalan, panel:count) — callback'ni yopib qo'yamiz
     await cq.answer()
 
 @dp.message(Command("cancel"))
+@admin_required()
 async def cancel_any(msg: Message, state: FSMContext):
-    if not await is_admin(msg.from_user.id):
-        return
     await state.clear()
     await msg.answer("Bekor qilindi. Normal rejimga qaytdik.")
 
-# ---------- Broadcast (parallel, throttled) ----------
-@dp.message(BroadcastStates.waiting_content)
-async def do_broadcast(msg: Message, state: FSMContext):
-    if not await is_admin(msg.from_user.id):
-        return
-
-    user_ids = await db.list_user_ids()
-    total = len(user_ids)
-
-    # Tezkor lekin ehtiyot: 20 ta parallel oqim
-    sem = asyncio.Semaphore(20)
-    ok = 0
-    fail = 0
-
-    async def send_copy(uid: int):
-        nonlocal ok, fail
-        async with sem:
-            try:
-                await msg.copy_to(chat_id=uid)
-                ok += 1
-            except Exception:
-                fail += 1
-
-    await asyncio.gather(*(send_copy(uid) for uid in user_ids))
-
-    await state.clear()
-    await msg.answer(f"Broadcast yakunlandi.\nYuborildi: <b>{ok}</b> / Jami: {total} / Xato: {fail}")
-
 # ---------- Reply flow ----------
 @dp.callback_query(F.data.startswith("reply:"))
+@admin_required()
 async def start_reply(cq: CallbackQuery, state: FSMContext):
-    if not await is_admin(cq.from_user.id):
-        return
-    target_id = int(cq.data.split(":", 1)[1])
+    _, _, target = cq.data.partition(":")
+    target_id = int(target)
     await state.update_data(target_id=target_id)
     await state.set_state(ReplyStates.waiting_text)
     await cq.message.answer(
@@ -480,23 +704,21 @@ async def start_reply(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 @dp.message(Command("done"))
+@admin_required()
 async def finish_reply(msg: Message, state: FSMContext):
-    if not await is_admin(msg.from_user.id):
-        return
     await state.clear()
     await msg.answer("Reply rejimi yopildi.")
 
 @dp.message(ReplyStates.waiting_text)
+@admin_required()
 async def forward_reply(msg: Message, state: FSMContext):
-    if not await is_admin(msg.from_user.id):
-        return
     data = await state.get_data()
     target_id = data.get("target_id")
     if not target_id:
         await msg.answer("Target yo'q. /done qilib chiqib, tugma orqali qayta kir.")
         return
     try:
-        await msg.copy_to(chat_id=target_id)
+        await tg_send(target_id, lambda: msg.copy_to(chat_id=target_id))
         await msg.answer(f"✔️ Yuborildi → <code>{target_id}</code>")
     except Exception as e:
         await msg.answer(f"❌ Yuborilmadi: {e}")
@@ -505,25 +727,23 @@ async def forward_reply(msg: Message, state: FSMContext):
 
 # ---------- Admin management (panel) ----------
 @dp.callback_query(F.data == "admins:add")
+@admin_required("super")
 async def admins_add_start(cq: CallbackQuery, state: FSMContext):
-    if not await is_superadmin(cq.from_user.id):
-        await cq.answer("Faqat superadmin uchun.", show_alert=True)
-        return
     await state.set_state(AdminMgmtStates.waiting_add)
     await cq.message.answer("➕ Admin qo'shish: user_id yoki @username yuboring.\nYakunlash: /cancel")
     await cq.answer()
 
 async def _resolve_user_token(token: str) -> Optional[int]:
-    token = (token or "").strip()
-    if token.isdigit():
+    token = (token or "").strip().removeprefix("@")
+    # isascii: '²' kabi unicode raqamlar isdigit() dan o'tadi, lekin int() yiqiladi
+    if token.isascii() and token.isdigit():
         return int(token)
-    # username orqali DBdan topamiz
+    # username orqali: DBdan (indekslangan)
     return await db.find_user_id_by_username(token)
 
 @dp.message(AdminMgmtStates.waiting_add)
+@admin_required("super")
 async def admins_add_do(msg: Message, state: FSMContext):
-    if not await is_superadmin(msg.from_user.id):
-        return
     uid = await _resolve_user_token(msg.text)
     if not uid:
         await msg.answer("❌ Topilmadi. user_id yoki @username yubor.")
@@ -536,18 +756,15 @@ async def admins_add_do(msg: Message, state: FSMContext):
     await state.clear()
 
 @dp.callback_query(F.data == "admins:remove")
+@admin_required("super")
 async def admins_remove_start(cq: CallbackQuery, state: FSMContext):
-    if not await is_superadmin(cq.from_user.id):
-        await cq.answer("Faqat superadmin uchun.", show_alert=True)
-        return
     await state.set_state(AdminMgmtStates.waiting_remove)
     await cq.message.answer("➖ Admin o‘chirish: user_id yoki @username yuboring.\nYakunlash: /cancel")
     await cq.answer()
 
 @dp.message(AdminMgmtStates.waiting_remove)
+@admin_required("super")
 async def admins_remove_do(msg: Message, state: FSMContext):
-    if not await is_superadmin(msg.from_user.id):
-        return
     uid = await _resolve_user_token(msg.text)
     if not uid:
         await msg.answer("❌ Topilmadi. user_id yoki @username yubor.")
@@ -560,21 +777,17 @@ async def admins_remove_do(msg: Message, state: FSMContext):
     await state.clear()
 
 @dp.callback_query(F.data == "admins:list")
+@admin_required("super")
 async def admins_list(cq: CallbackQuery):
-    if not await is_superadmin(cq.from_user.id):
-        await cq.answer("Faqat superadmin uchun.", show_alert=True)
-        return
     txt = await db.list_admins_text()
     await cq.message.answer(txt)
     await cq.answer()
 
 # ---------- Quick actions (promote/revoke) ----------
-@dp.callback_query(F.data.startswith("admins:promote:"))
-async def quick_promote(cq: CallbackQuery):
-    if not await is_superadmin(cq.from_user.id):
-        await cq.answer("Faqat superadmin uchun.", show_alert=True)
-        return
-    uid = int(cq.data.split(":")[2])
+@dp.callback_query(F.data.regexp(r"^admins:promote:(\d+)$").as_("m"))
+@admin_required("super")
+async def quick_promote(cq: CallbackQuery, m: re.Match):
+    uid = int(m.group(1))
     ok = await db.add_admin(uid)
     if ok:
         await cq.answer("Qo'shildi ✅", show_alert=False)
@@ -582,12 +795,10 @@ async def quick_promote(cq: CallbackQuery):
     else:
         await cq.answer("Qo'shilmadi (allaqachon admin yoki superadmin).", show_alert=True)
 
-@dp.callback_query(F.data.startswith("admins:revoke:"))
-async def quick_revoke(cq: CallbackQuery):
-    if not await is_superadmin(cq.from_user.id):
-        await cq.answer("Faqat superadmin uchun.", show_alert=True)
-        return
-    uid = int(cq.data.split(":")[2])
+@dp.callback_query(F.data.regexp(r"^admins:revoke:(\d+)$").as_("m"))
+@admin_required("super")
+async def quick_revoke(cq: CallbackQuery, m: re.Match):
+    uid = int(m.group(1))
     ok = await db.remove_admin(uid)
     if ok:
         await cq.answer("O‘chirildi ✅", show_alert=False)
@@ -596,9 +807,28 @@ async def quick_revoke(cq: CallbackQuery):
         await cq.answer("O‘chirilmadi (admin emas yoki superadmin).", show_alert=True)
 
 # ---------- User → Admin relay ----------
+_META_TMPL = (
+    "<b>Yangi xabar</b>\n"
+    "ID: <code>%d</code>\n"
+    "Username: %s\n"
+    "Ism: %s\n"
+    "Familiya: %s\n"
+    "Vaqt: %s"
+)
+
+# Bir soniya ichida kelgan xabarlar uchun vaqt qayta formatlanmaydi: [soniya, matn]
+_ts_cache: list = [0, ""]
+
+def _ts_now() -> str:
+    t = int(time.time())
+    if _ts_cache[0] != t:
+        _ts_cache[0] = t
+        _ts_cache[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+    return _ts_cache[1]
+
 @dp.message(CommandStart())
 async def start_cmd(msg: Message):
-    await db.upsert_user(msg.from_user)
+    await db.touch_user(msg.from_user)
     await msg.answer("Savolingizni yozing. Admin ko‘radi va javob beradi.")
 
 @dp.message(F.text | F.photo | F.video | F.audio | F.document | F.sticker | F.voice | F.video_note | F.animation)
@@ -606,34 +836,47 @@ async def relay_to_admins(msg: Message):
     if await is_admin(msg.from_user.id):
         return
 
-
-    await db.upsert_user(msg.from_user)
+    await db.touch_user(msg.from_user)
 
     u = msg.from_user
     username = f"@{u.username}" if u.username else "-"
     first = u.first_name or "-"
     last = u.last_name or "-"
-    meta = (
-        f"<b>Yangi xabar</b>\n"
-        f"ID: <code>{u.id}</code>\n"
-        f"Username: {username}\n"
-        f"Ism: {first}\n"
-        f"Familiya: {last}\n"
-        f"Vaqt: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    )
+    ts = _ts_now()
+    meta = _META_TMPL % (u.id, username, first, last, ts)
+
+    # Adminlar snapshot'i bir marta olinadi, har admin uchun alohida tekshirmaymiz
+    snap = await _cache()
+    supers = snap.superadmin_ids
+    # Faqat 2 xil klaviatura bo'lishi mumkin — bir marta olamiz
+    kb_super = reply_kb(u.id, superadmin=True)
+    kb_plain = reply_kb(u.id, superadmin=False)
+
+    # Faqat matn bo'lsa — meta bilan bitta xabarga jamlaymiz (2 ta so'rov o'rniga 1 ta)
+    combined = None
+    if msg.text is not None:
+        combined = f"{meta}\n\n{msg.html_text}"
+        if len(combined.encode("utf-16-le")) // 2 > TG_MAX_TEXT_LEN:
+            combined = None
+
+    sem = asyncio.Semaphore(RELAY_CONCURRENCY)
+
+    async def send_to(aid: int):
+        async with sem:
+            try:
+                kb = kb_super if aid in supers else kb_plain
+                if combined is not None:
+                    await tg_send(aid, lambda: bot.send_message(aid, combined, reply_markup=kb))
+                    return
+                # Bitta admin ichida tartib muhim: avval meta, keyin xabarning o'zi
+                await tg_send(aid, lambda: bot.send_message(aid, meta, reply_markup=kb))
+                await tg_send(aid, lambda: msg.copy_to(chat_id=aid))
+            except Exception:
+                # Admin bloklagan bo'lishi mumkin — baribir davom etamiz
+                pass
 
-    admin_ids = await all_admin_ids()
-    for aid in admin_ids:
-        try:
-            await bot.send_message(
-                aid,
-                meta,
-                reply_markup=reply_kb(u.id, superadmin=await is_superadmin(aid)),
-            )
-            await msg.copy_to(chat_id=aid)
-        except Exception:
-            # Admin bloklagan bo'lishi mumkin — baribir davom etamiz
-            pass
+    # Adminlar orasida parallel (RELAY_CONCURRENCY bilan cheklangan)
+    await asyncio.gather(*(send_to(aid) for aid in snap.ids))
 
 # ---------- Run ----------
 async def main():
@@ -641,6 +884,7 @@ async def main():
     await db.connect()
     await db.ensure_schema()
     await db.seed_admins(SEED_SUPERADMINS, SEED_ADMINS)
+    await _cache()
     await dp.start_polling(bot)
 
 if __name__ == "__main__":